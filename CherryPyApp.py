@@ -77,8 +77,13 @@ class MyRoutesDispatcher(cherrypy.dispatch.RoutesDispatcher):
         cherrypy.dispatch.RoutesDispatcher.connect(self, name, route, controller, **kwargs)
 
 
-def main():
-    """ Main function. """
+def main(wsgi=False):
+    """ Main function.
+
+    With wsgi=True the app is set up to be hosted by an external WSGI
+    server, which then owns the sockets, signals and worker processes.
+
+    """
 
     # default config
     cherrypy.config.update({
@@ -164,7 +169,7 @@ def main():
     
     cherrypy.config.update({'error_page.404': error_page_404})
 
-    if hasattr(cherrypy.engine, 'signal_handler'):
+    if hasattr(cherrypy.engine, 'signal_handler') and not wsgi:
         cherrypy.engine.signal_handler.subscribe()
 
     GutenbergDatabase.options.update(cherrypy.config)
@@ -172,12 +177,13 @@ def main():
         cherrypy.engine, params=GutenbergDatabase.get_connection_params(cherrypy.config))
     cherrypy.engine.pool.subscribe()
 
-    timer = plugins.Timer(cherrypy.engine)
+    # under a WSGI server the first refresh runs on the timer thread, after boot
+    timer = plugins.Timer(cherrypy.engine, refresh_on_start=not wsgi)
     timer.subscribe()
 
     cherrypy.log("Daemonizing", context='ENGINE', severity=logging.INFO)
 
-    if cherrypy.config['daemonize']:
+    if cherrypy.config['daemonize'] and not wsgi:
         plugins.Daemonizer(cherrypy.engine).subscribe()
 
     uid = cherrypy.config['uid']
@@ -185,7 +191,7 @@ def main():
     if uid > 0 or gid > 0:
         plugins.DropPrivileges(cherrypy.engine, uid=uid, gid=gid, umask=0o22).subscribe()
 
-    if cherrypy.config['pidfile']:
+    if cherrypy.config['pidfile'] and not wsgi:
         pid = plugins.PIDFile(cherrypy.engine, cherrypy.config['pidfile'])
         # Write pidfile after privileges are dropped(prio == 77)
         # or we will not be able to remove it.
@@ -340,9 +346,27 @@ def main():
         }
     })
 
+    if wsgi:
+        cherrypy.server.unsubscribe()
+
     return app
 
 
+def wsgi_app():
+    """ Entry point for multi-process WSGI servers.
+
+    Every worker process gets its own engine, connection pool and timer:
+
+      gunicorn -w 4 -k gthread --threads 8 'CherryPyApp:wsgi_app()'
+
+    Do not use --preload, the engine threads must start after the fork.
+
+    """
+    main(wsgi=True)
+    cherrypy.engine.start()
+    return cherrypy.tree
+
+
 if __name__ == '__main__':
     main()
     cherrypy.engine.start()
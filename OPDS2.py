@@ -4,13 +4,18 @@ OPDS2.py — Zachary Rosario
 OPDS 2.0 JSON feed for the Project Gutenberg catalog.
 """
 
+import functools
+import hashlib
+import json
 import random
 from concurrent.futures import ThreadPoolExecutor
 from typing import Callable, Dict, List, Optional, Tuple
-from urllib.parse import urlencode
+from urllib.parse import quote_plus
 import logging
 
 import cherrypy
+from cherrypy.lib import httputil
+from repoze.lru import ExpiringLRUCache
 
 from mv_search.constants import (
     Crosswalk,
@@ -23,24 +28,100 @@ from mv_search.constants import (
 )
 from mv_search.Search import FullTextSearch
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class _ContextLog(logging.LoggerAdapter):
+    """Prefix records with time and context, as cherrypy.log() does.
+
+    The error log's handlers only print the message (cherrypy._cplogging.logfmt).
+    process() only runs for enabled levels, so disabled records stay unformatted.
+    """
+
+    def process(self, msg, kwargs):
+        return f"{cherrypy.log.time()} {self.extra['context']} {msg}", kwargs
+
+
+# Child of CherryPy's error log, so records reach its handlers
+log = _ContextLog(logging.getLogger("cherrypy.error.opds"), {"context": "OPDS"})
+
 SAMPLE_LIMIT = 15
+LOCC_WORKERS = 8
+# Threads shared by all search requests for their secondary queries
+SEARCH_WORKERS = 8
+# Publications serialized per chunk when streaming a feed
+STREAM_BATCH = 20
 # Most common Gutenberg languages first, remainder alphabetical by label
 _LANG_PRIORITY = [
     "en", "fr", "de", "fi", "nl", "it", "pt", "es", "zh",
     "la", "el", "grc", "hu", "sv", "da", "no", "pl", "ru", "cs", "ja",
 ]
-LANGUAGES = sorted(
-    [{"code": lang.code, "label": lang.label} for lang in Language],
-    key=lambda x: (_LANG_PRIORITY.index(x["code"]) if x["code"] in _LANG_PRIORITY else 999, x["label"]),
+# (code, label, url-encoded code) in facet display order
+_LANG_TABLE: Tuple[Tuple[str, str, str], ...] = tuple(
+    (lang.code, lang.label, quote_plus(lang.code))
+    for lang in sorted(
+        Language,
+        key=lambda x: (_LANG_PRIORITY.index(x.code) if x.code in _LANG_PRIORITY else 999, x.label),
+    )
 )
-VALID_SORTS = set(OrderBy._value2member_map_.keys())
+# Literal href prefixes; the id or code is appended per link
+_SHELF_PREFIX = "/opds/bookshelves?id="
+_CATEGORY_PREFIX = "/opds/bookshelves?category="
+_LOCC_PREFIX = "/opds/loccs?parent="
+_SUBJECT_PREFIX = "/opds/subjects?id="
+# LoCC main class code -> label
+_LOCC_MAIN_LABELS = {item.code: item.label for item in LoCCMainClass}
+# category name -> category
+_CATEGORY_INDEX = {cat.name: cat for cat in CuratedBookshelves}
+# shelf id -> (shelf name, category name)
+_SHELF_INDEX = {
+    sid: (sname, cat.name) for cat in CuratedBookshelves for sid, sname in cat.shelves
+}
+# sort param value -> OrderBy member
+_SORT_ORDERS = {order.value: order for order in OrderBy}
 OPDS_TYPE = "application/opds+json"
+# Part of every ETag next to the view's refresh stamp; bump it when the
+# feed output changes so clients drop feeds cached by older code
+FEED_VERSION = "1"
+# Navigation roots only change when the catalog does
+NAV_CACHE_CONTROL = "public, max-age=86400"
+# DB-derived results are kept this long, or until the next mv_books_dc refresh
+CACHE_TTL = 300
+SUBJECTS_CACHE_SIZE = 2048
+# Serialized feed bodies, some tens of KB each
+FEED_CACHE_SIZE = 1024
+# Most-used subjects whose first feed page is rebuilt after a view refresh
+PREWARM_SUBJECTS = 50
+LOCC_NAV_CACHE_SIZE = 1024
+# Cache miss marker for caches that also hold None
+_MISSING = object()
+# Params overridden per facet link; everything else in a feed's base is shared
+_FACET_PARAMS = frozenset(("query", "page", "lang", "copyrighted", "audiobook", "sort", "sort_order"))
+# (title, sort, sort_order) for the "Sort By" facet
+_SORT_FACETS = (
+    ("Most Popular", "downloads", "desc"),
+    ("Relevance", "relevance", ""),
+    ("Title (A-Z)", "title", "asc"),
+    ("Author (A-Z)", "author", "asc"),
+    ("Random", "random", ""),
+)
+# (title, value) for the "Copyright Status" and "Format" facets
+_COPYRIGHT_FACETS = (("Any", ""), ("Public Domain", "false"), ("Copyrighted", "true"))
+_FORMAT_FACETS = (("Any", ""), ("Text", "false"), ("Audiobook", "true"))
 
 
 # Helpers
-def _link(rel: str, href: str, **extras) -> Dict:
+def _link(rel: str, href: str) -> Dict:
     """Create an OPDS link dict."""
-    return {"rel": rel, "href": href, "type": OPDS_TYPE, **extras}
+    return {"rel": rel, "href": href, "type": OPDS_TYPE}
+
+
+def _templated_link(rel: str, href: str) -> Dict:
+    """Create a templated OPDS link dict (e.g. a search template)."""
+    return {"rel": rel, "href": href, "type": OPDS_TYPE, "templated": True}
 
 
 def _nav(href: str, title: str) -> Dict:
@@ -48,6 +129,17 @@ def _nav(href: str, title: str) -> Dict:
     return {"href": href, "title": title, "type": OPDS_TYPE, "rel": "subsection"}
 
 
+def _counted_nav(href: str, title: str, count: int) -> Dict:
+    """Create a navigation item carrying its number of items."""
+    return {
+        "href": href,
+        "title": title,
+        "type": OPDS_TYPE,
+        "rel": "subsection",
+        "properties": {"numberOfItems": count},
+    }
+
+
 def _facet(href: str, title: str, active: bool) -> Dict:
     """Create a facet link. Includes 'rel': 'self' only if active."""
     link = {"href": href, "type": OPDS_TYPE, "title": title}
@@ -56,41 +148,209 @@ def _facet(href: str, title: str, active: bool) -> Dict:
     return link
 
 
+# Links identical in every response, shared between feeds; never mutate them
+_START_LINK = _link("start", "/opds/")
+_UP_ROOT_LINK = _link("up", "/opds/")
+_UP_BOOKSHELVES_LINK = _link("up", "/opds/bookshelves")
+_UP_LOCCS_LINK = _link("up", "/opds/loccs")
+_UP_SUBJECTS_LINK = _link("up", "/opds/subjects")
+_INDEX_SELF_LINK = _link("self", "/opds/")
+_INDEX_SEARCH_LINK = _templated_link("search", "/opds/search{?query}")
+_RECENT_SELF_LINK = _link("self", "/opds/search?sort=release_date&sort_order=desc")
+_POPULAR_SELF_LINK = _link("self", "/opds/search?sort=downloads&sort_order=desc")
+_AUDIOBOOKS_SELF_LINK = _link("self", "/opds/search?audiobook=true&sort=downloads")
+_BOOKSHELVES_SELF_LINK = _link("self", "/opds/bookshelves")
+_LOCCS_SELF_LINK = _link("self", "/opds/loccs")
+_SUBJECTS_SELF_LINK = _link("self", "/opds/subjects")
+_CATEGORY_SELF_LINKS = {
+    cat.name: _link("self", _CATEGORY_PREFIX + cat.name) for cat in CuratedBookshelves
+}
+_CATEGORY_UP_LINKS = {
+    cat.name: _link("up", _CATEGORY_PREFIX + cat.name) for cat in CuratedBookshelves
+}
+_SHELF_SELF_LINKS = {sid: _link("self", f"{_SHELF_PREFIX}{sid}") for sid in _SHELF_INDEX}
+
+
+def _query_string(params: Dict) -> str:
+    """Encode params like urlencode(doseq=True) in one pass, omitting empty values.
+
+    Keys are our own parameter names and are not escaped.
+    """
+    parts = []
+    for k, v in params.items():
+        if v in ("", None):
+            continue
+        if isinstance(v, (list, tuple)):
+            parts.extend(f"{k}={quote_plus(str(x))}" for x in v)
+        else:
+            parts.append(f"{k}={quote_plus(str(v))}")
+    return "&".join(parts)
+
+
 def _url(path: str, params: Dict) -> str:
     """Build URL with query string, omitting empty values."""
-    clean = {k: v for k, v in params.items() if v not in ("", None)}
-    return f"{path}?{urlencode(clean, doseq=True)}" if clean else path
+    qs = _query_string(params)
+    return f"{path}?{qs}" if qs else path
+
+
+def _make_page_url(endpoint: str, base: Dict, query: str) -> Callable[..., str]:
+    """Create a page URL builder for pagination links.
 
+    Everything but the page and cursor is fixed for a feed, so the URL up to
+    the page number is encoded once and each call only appends to it.
+    """
+    head = _query_string({**base, "query": query})
+    head = f"{endpoint}?{head}&page=" if head else f"{endpoint}?page="
 
-def _make_page_url(endpoint: str, base: Dict, query: str) -> Callable[[int], str]:
-    """Create a page URL builder for pagination links."""
-    def page_url(p: int) -> str:
-        return _url(endpoint, {**base, "query": query, "page": p})
+    def page_url(p: int, cursor: str = "") -> str:
+        if cursor:
+            return f"{head}{p}&cursor={quote_plus(cursor)}"
+        return f"{head}{p}"
     return page_url
 
 
-def _make_facet_url(endpoint: str, base: Dict) -> Callable[..., str]:
-    """Create a facet URL builder for filter facets."""
-    def facet_url(q: str, lng: str, cr: str, ab: str, srt: str, so: str) -> str:
-        return _url(endpoint, {
-            **base,
-            "query": q,
-            "page": 1,
-            "lang": lng,
-            "copyrighted": cr,
-            "audiobook": ab,
-            "sort": srt,
-            "sort_order": so,
-        })
-    return facet_url
+def _facet_prefix(endpoint: str, base: Dict) -> str:
+    """Encode the params shared by every facet link of a feed, once."""
+    encoded_base = _query_string(
+        {k: v for k, v in base.items() if k not in _FACET_PARAMS}
+    )
+    return f"{endpoint}?{encoded_base}&" if encoded_base else f"{endpoint}?"
+
+
+def _param(name: str, value: str) -> str:
+    """Encode one query param, or "" for an empty value (omitted like in _query_string)."""
+    return f"{name}={quote_plus(value)}" if value else ""
+
+
+def _join_params(prefix: str, *params: str) -> str:
+    """Append already encoded params to a facet prefix, skipping empty ones."""
+    return prefix + "&".join([p for p in params if p])
+
+
+def _filter_facets(
+    prefix: str,
+    query: str,
+    lang: str,
+    copyrighted: str,
+    audiobook: str,
+    sort: str,
+    sort_order: str,
+) -> Tuple[Dict, Dict, Dict, Dict]:
+    """Build the sort, copyright, format and language facet groups.
+
+    These depend only on the feed prefix and filter state, not on the page;
+    _filter_facets_json memoizes them, serialized.
+    """
+    # Each facet link swaps one setting of the current state: encode every
+    # param once and join the pieces per link
+    q = _param("query", query)
+    lng = _param("lang", lang)
+    cr = _param("copyrighted", copyrighted)
+    ab = _param("audiobook", audiobook)
+    srt = _param("sort", sort)
+    so = _param("sort_order", sort_order)
+
+    sort_by = {
+        "metadata": {"title": "Sort By"},
+        "links": [
+            _facet(
+                _join_params(
+                    prefix, q, "page=1", lng, cr, ab,
+                    _param("sort", value), _param("sort_order", order),
+                ),
+                title,
+                sort == value or (value == "downloads" and not sort),
+            )
+            for title, value, order in _SORT_FACETS
+        ],
+    }
+    copyright_status = {
+        "metadata": {"title": "Copyright Status"},
+        "links": [
+            _facet(
+                _join_params(prefix, q, "page=1", lng, _param("copyrighted", value), ab, srt, so),
+                title,
+                copyrighted == value,
+            )
+            for title, value in _COPYRIGHT_FACETS
+        ],
+    }
+    file_format = {
+        "metadata": {"title": "Format"},
+        "links": [
+            _facet(
+                _join_params(prefix, q, "page=1", lng, cr, _param("audiobook", value), srt, so),
+                title,
+                audiobook == value,
+            )
+            for title, value in _FORMAT_FACETS
+        ],
+    }
+    # The language links are many; splice the pre-encoded code between fixed halves
+    lang_head = _join_params(prefix, q, "page=1") + "&lang="
+    lang_tail = "".join(["&" + p for p in (cr, ab, srt, so) if p])
+    language = {
+        "metadata": {"title": "Language"},
+        "links": [
+            _facet(_join_params(prefix, q, "page=1", cr, ab, srt, so), "Any", not lang),
+            *(
+                _facet(lang_head + encoded + lang_tail, label, lang == code)
+                for code, label, encoded in _LANG_TABLE
+            ),
+        ],
+    }
+    return sort_by, copyright_status, file_format, language
+
+
+@functools.lru_cache(maxsize=1024)
+def _filter_facets_json(
+    prefix: str,
+    query: str,
+    lang: str,
+    copyrighted: str,
+    audiobook: str,
+    sort: str,
+    sort_order: str,
+) -> Tuple[bytes, bytes, bytes, bytes]:
+    """_filter_facets, serialized once per filter state."""
+    return tuple(
+        _dumps(group)
+        for group in _filter_facets(
+            prefix, query, lang, copyrighted, audiobook, sort, sort_order
+        )
+    )
+
+
+def _subjects_facet_json(subjects: List[Dict]) -> bytes:
+    """Serialize the "Top Subjects in Results" facet group."""
+    return _dumps(
+        {
+            "metadata": {"title": "Top Subjects in Results"},
+            "links": [
+                {
+                    "href": f"{_SUBJECT_PREFIX}{s['id']}",
+                    "type": OPDS_TYPE,
+                    "title": s["name"],
+                    "properties": {"numberOfItems": s["count"]},
+                }
+                for s in subjects
+            ],
+        }
+    )
+
+
+def _as_int(value, fallback: int) -> int:
+    """Read a query-string integer without raising; fallback if it isn't one."""
+    if type(value) is int:
+        return value
+    if isinstance(value, str) and value.isdecimal() and len(value) < 10:
+        return int(value)
+    return fallback
 
 
 def _paginate(page, limit, default=25) -> Tuple[int, int]:
     """Parse and clamp pagination params."""
-    try:
-        return max(1, int(page)), max(1, min(100, int(limit)))
-    except (ValueError, TypeError):
-        return 1, default
+    return max(1, _as_int(page, 1)), max(1, min(100, _as_int(limit, default)))
 
 
 def _search_type(field: str) -> SearchType:
@@ -100,15 +360,197 @@ def _search_type(field: str) -> SearchType:
     return SearchType.FUZZY
 
 
+_SORT_DIRECTIONS = {"asc": SortDirection.ASC, "desc": SortDirection.DESC}
+
+
 def _sort_direction(order: str) -> Optional[SortDirection]:
     """Parse sort order string."""
-    return {"asc": SortDirection.ASC, "desc": SortDirection.DESC}.get(order)
+    return _SORT_DIRECTIONS.get(order)
+
+
+def _dumps(value) -> bytes:
+    """Serialize to UTF-8 JSON, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS)
+    # Same compact, unescaped UTF-8 output as orjson
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def _json_handler(*args, **kwargs) -> bytes:
+    """json_out handler that serializes the page handler's result with _dumps."""
+    return _dumps(cherrypy.serving.request._json_inner_handler(*args, **kwargs))
+
+
+# First chunk of a streamed feed: envelope without its closing brace, then
+# the facets (already serialized JSON, see OPDSFeed._facets), if any
+_FEED_HEAD = b'%b"publications":['
+_FACETED_FEED_HEAD = b'%b"facets":%b,"publications":['
+
+
+def _iter_feed(feed: Dict):
+    """Yield a feed as JSON, with its publications last and serialized in batches."""
+    publications = feed["publications"]
+    facets = feed.get("facets")
+    head = _dumps({k: v for k, v in feed.items() if k not in ("publications", "facets")})
+    head = head[:-1] + b"," if len(head) > 2 else b"{"
+    if facets is None:
+        yield _FEED_HEAD % head
+    else:
+        yield _FACETED_FEED_HEAD % (head, facets)
+    for i in range(0, len(publications), STREAM_BATCH):
+        batch = _dumps(publications[i:i + STREAM_BATCH])[1:-1]
+        yield batch if i == 0 else b"," + batch
+    yield b"]}"
+
+
+def _feed_body(feed: Dict) -> bytes:
+    """Serialize a feed in one piece, as the bytes _iter_feed would stream."""
+    return b"".join(_iter_feed(feed))
+
+
+def _log_failure(future) -> None:
+    """Done callback for background tasks, whose result nobody reads."""
+    error = future.exception()
+    if error is not None:
+        log.error("Background task failed", exc_info=error)
+
+
+def _stream_json_handler(*args, **kwargs):
+    """json_out handler that streams feeds carrying publications, see _iter_feed.
+
+    Bytes are an already serialized body (see OPDSFeed._feed_cache) and are
+    sent as they are.
+    """
+    value = cherrypy.serving.request._json_inner_handler(*args, **kwargs)
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, dict) and "publications" in value:
+        cherrypy.serving.response.stream = True
+        return _iter_feed(value)
+    return _dumps(value)
+
+
+def _opds_cache():
+    """Tag a finished feed with an ETag and answer a matching If-None-Match with 304.
+
+    Streamed bodies are left alone, hashing them would mean buffering them;
+    the streamed book feeds are tagged up front by OPDSFeed._not_modified.
+    So are bodies a handler marked as random samples (request.opds_random),
+    which differ on every request and could never match.
+    """
+    request, response = cherrypy.serving.request, cherrypy.serving.response
+    if response.stream or request.method not in ("GET", "HEAD"):
+        return
+    if getattr(request, "opds_random", False):
+        return
+    if httputil.valid_status(response.status)[0] != 200:
+        return
+
+    etag = response.headers.get("ETag")
+    if not etag:
+        etag = '"%s"' % hashlib.md5(response.collapse_body()).hexdigest()
+        response.headers["ETag"] = etag
+
+    conditions = [str(x) for x in request.headers.elements("If-None-Match")]
+    if etag in conditions or conditions == ["*"]:
+        raise cherrypy.HTTPRedirect([], 304)
+
+
+cherrypy.tools.opds_cache = cherrypy.Tool("before_finalize", _opds_cache)
 
 
 # CherryPy Search API
 class OPDSFeed:
     def __init__(self):
         self._fts = None
+        self._subjects_cache = ExpiringLRUCache(SUBJECTS_CACHE_SIZE, default_timeout=CACHE_TTL)
+        # Serialized subject and search feed bodies by request params
+        self._feed_cache = ExpiringLRUCache(FEED_CACHE_SIZE, default_timeout=CACHE_TTL)
+        # LoCC parent -> navigation feed, or None for leaves (which list books)
+        self._locc_nav_cache = ExpiringLRUCache(LOCC_NAV_CACHE_SIZE, default_timeout=CACHE_TTL)
+        self._executor = ThreadPoolExecutor(max_workers=SEARCH_WORKERS)
+        # Read from the view on first use and after every refresh, see _view_version
+        self._mv_version = None
+        # Published by the Timer plugin after it refreshes mv_books_dc
+        cherrypy.engine.subscribe("mv_refresh", self._clear_caches)
+
+    def _clear_caches(self):
+        """Drop results computed from the previous materialized view."""
+        self._subjects_cache.clear()
+        self._feed_cache.clear()
+        self._locc_nav_cache.clear()
+        self._mv_version = None
+        # One pool thread, so searches still get the others
+        self._executor.submit(self._prewarm).add_done_callback(_log_failure)
+
+    def _prewarm(self):
+        """Rebuild the feeds most likely to be requested next from the new view.
+
+        Fills the same caches requests read: LoCC navigation for the root and
+        each main class, and the first page of the most-used subjects.
+        """
+        for code in ("", *_LOCC_MAIN_LABELS):
+            try:
+                self._locc_nav(code)
+            except Exception as e:
+                log.warning("Prewarm error (LoCC %s): %s", code or "root", e)
+        try:
+            subjects = sorted(
+                self.fts.list_subjects(), key=lambda x: x["book_count"], reverse=True
+            )
+        except Exception as e:
+            log.warning("Prewarm error: %s", e)
+            return
+        for s in subjects[:PREWARM_SUBJECTS]:
+            try:
+                self._subject_books(s["id"], 1, 25, "", "", "", "", "", "", conditional=False)
+            except Exception as e:
+                log.warning("Prewarm error (subject %s): %s", s["id"], e)
+
+    def _view_version(self) -> Optional[str]:
+        """Version of the mv_books_dc contents, or None if it cannot be read.
+
+        Built from the stamp the Timer leaves on the view at every refresh,
+        so all server processes on the same database agree on it.
+        """
+        version = self._mv_version
+        if version is None:
+            try:
+                stamp = self.fts.get_refresh_stamp()
+            except Exception as e:
+                log.warning("View version error: %s", e)
+                return None
+            version = self._mv_version = f"{FEED_VERSION}:{stamp or ''}"
+        return version
+
+    def _not_modified(self, version: Optional[str], key: Tuple) -> None:
+        """ETag a feed by view version and request params before building it.
+
+        Feeds only change when mv_books_dc is refreshed, so a client that
+        already holds this one gets a 304 without any query being run.
+        Without a view version the feed is sent untagged.
+
+        version is read once when the request starts, and also keys what the
+        request caches: a request that overlaps a refresh may have read the
+        old view, and must not fill the cache for the new version's ETag.
+        """
+        if version is None:
+            return
+        request = cherrypy.serving.request
+        digest = hashlib.blake2b(repr((version, key)).encode("utf-8"), digest_size=16)
+        etag = '"%s"' % digest.hexdigest()
+        cherrypy.serving.response.headers["ETag"] = etag
+        if request.method in ("GET", "HEAD"):
+            conditions = [str(x) for x in request.headers.elements("If-None-Match")]
+            if etag in conditions or conditions == ["*"]:
+                raise cherrypy.HTTPRedirect([], 304)
+
+    def _incomplete(self) -> None:
+        """Withdraw the ETag of a feed built without some of its parts.
+
+        Such a feed must not be cached, nor revalidated until the next refresh.
+        """
+        cherrypy.serving.response.headers.pop("ETag", None)
 
     @property
     def fts(self):
@@ -133,173 +575,91 @@ class OPDSFeed:
 
     def _sort(self, q, sort: str, sort_order: str):
         """Apply sorting to query."""
-        if sort in VALID_SORTS:
-            q.order_by(OrderBy(sort), _sort_direction(sort_order))
+        order = _SORT_ORDERS.get(sort)
+        if order is not None:
+            q.order_by(order, _sort_direction(sort_order))
         else:
             q.order_by(OrderBy.DOWNLOADS)
         return q
 
-    def _top_subjects(self, q) -> Optional[List[Dict]]:
-        """Get top subjects for a query."""
+    def _top_subjects(self, q, key: Optional[Tuple] = None) -> Optional[bytes]:
+        """Get the serialized "Top Subjects in Results" facet group for a query.
+
+        Empty bytes when the query has no subjects, None if they could not be
+        fetched. key identifies the view version and filter state (never the
+        page); when given, the rendered group is cached so paging through a
+        feed builds it once.
+        """
+        if key is not None:
+            facet = self._subjects_cache.get(key)
+            if facet is not None:
+                return facet
         try:
-            return self.fts.get_top_subjects_for_query(q, limit=15, max_books=500)
+            subjects = self.fts.get_top_subjects_for_query(q, limit=15, max_books=500)
         except Exception as e:
-            cherrypy.log(f"Top subjects error: {e}")
+            log.warning("Top subjects error: %s", e)
             return None
+        facet = _subjects_facet_json(subjects) if subjects else b""
+        if key is not None:
+            self._subjects_cache.put(key, facet)
+        return facet
 
     # Feed Building
     def _pagination_links(
-        self, url_fn: Callable, page: int, total_pages: int
+        self,
+        links: List[Dict],
+        url_fn: Callable,
+        page: int,
+        total_pages: int,
+        next_cursor: Optional[str] = None,
     ) -> List[Dict]:
-        """Build pagination links."""
-        links = []
+        """Append pagination links to links. 'next' carries the keyset cursor when there is one."""
         if page > 1:
-            links.append(_link("first", url_fn(1)))
-            links.append(_link("previous", url_fn(page - 1)))
+            first = url_fn(1)
+            links.append(_link("first", first))
+            links.append(_link("previous", first if page == 2 else url_fn(page - 1)))
         if page < total_pages:
-            links.append(_link("next", url_fn(page + 1)))
+            links.append(_link("next", url_fn(page + 1, next_cursor or "")))
             links.append(_link("last", url_fn(total_pages)))
         return links
 
     def _facets(
         self,
-        url_fn: Callable,
+        facet_prefix: str,
         query: str,
         lang: str,
         copyrighted: str,
         audiobook: str,
         sort: str,
         sort_order: str,
-        subjects: Optional[List[Dict]] = None,
-    ) -> List[Dict]:
-        """Build common facets for sort, copyright, format, language."""
-        facets = [
-            {
-                "metadata": {"title": "Sort By"},
-                "links": [
-                    _facet(
-                        url_fn(
-                            query, lang, copyrighted, audiobook, "downloads", "desc"
-                        ),
-                        "Most Popular",
-                        sort in ("downloads", ""),
-                    ),
-                    _facet(
-                        url_fn(query, lang, copyrighted, audiobook, "relevance", ""),
-                        "Relevance",
-                        sort == "relevance",
-                    ),
-                    _facet(
-                        url_fn(query, lang, copyrighted, audiobook, "title", "asc"),
-                        "Title (A-Z)",
-                        sort == "title",
-                    ),
-                    _facet(
-                        url_fn(query, lang, copyrighted, audiobook, "author", "asc"),
-                        "Author (A-Z)",
-                        sort == "author",
-                    ),
-                    _facet(
-                        url_fn(query, lang, copyrighted, audiobook, "random", ""),
-                        "Random",
-                        sort == "random",
-                    ),
-                ],
-            }
-        ]
+        subjects: Optional[bytes] = None,
+    ) -> bytes:
+        """Build common facets for sort, copyright, format, language.
+
+        Returned as a serialized JSON array for _iter_feed to splice into the
+        streamed feed; the filter groups are serialized once per filter state.
+        subjects is the already serialized group from _top_subjects.
+        """
+        sort_by, copyright_status, file_format, language = _filter_facets_json(
+            facet_prefix, query, lang, copyrighted, audiobook, sort, sort_order
+        )
+        facets = [sort_by]
 
         if subjects:
-            facets.append(
-                {
-                    "metadata": {"title": "Top Subjects in Results"},
-                    "links": [
-                        {
-                            "href": f"/opds/subjects?id={s['id']}",
-                            "type": OPDS_TYPE,
-                            "title": s["name"],
-                            "properties": {"numberOfItems": s["count"]},
-                        }
-                        for s in subjects
-                    ],
-                }
-            )
+            facets.append(subjects)
 
-        facets.extend(
-            [
-                {
-                    "metadata": {"title": "Copyright Status"},
-                    "links": [
-                        _facet(
-                            url_fn(query, lang, "", audiobook, sort, sort_order),
-                            "Any",
-                            not copyrighted,
-                        ),
-                        _facet(
-                            url_fn(query, lang, "false", audiobook, sort, sort_order),
-                            "Public Domain",
-                            copyrighted == "false",
-                        ),
-                        _facet(
-                            url_fn(query, lang, "true", audiobook, sort, sort_order),
-                            "Copyrighted",
-                            copyrighted == "true",
-                        ),
-                    ],
-                },
-                {
-                    "metadata": {"title": "Format"},
-                    "links": [
-                        _facet(
-                            url_fn(query, lang, copyrighted, "", sort, sort_order),
-                            "Any",
-                            not audiobook,
-                        ),
-                        _facet(
-                            url_fn(query, lang, copyrighted, "false", sort, sort_order),
-                            "Text",
-                            audiobook == "false",
-                        ),
-                        _facet(
-                            url_fn(query, lang, copyrighted, "true", sort, sort_order),
-                            "Audiobook",
-                            audiobook == "true",
-                        ),
-                    ],
-                },
-                {
-                    "metadata": {"title": "Language"},
-                    "links": [
-                        _facet(
-                            url_fn(query, "", copyrighted, audiobook, sort, sort_order),
-                            "Any",
-                            not lang,
-                        )
-                    ]
-                    + [
-                        _facet(
-                            url_fn(
-                                query,
-                                item["code"],
-                                copyrighted,
-                                audiobook,
-                                sort,
-                                sort_order,
-                            ),
-                            item["label"],
-                            lang == item["code"],
-                        )
-                        for item in LANGUAGES
-                    ],
-                },
-            ]
-        )
-        return facets
+        facets.extend((copyright_status, file_format, language))
+        return b"[" + b",".join(facets) + b"]"
 
     # Index
     @cherrypy.expose
-    @cherrypy.tools.json_out()
+    @cherrypy.tools.json_out(content_type=OPDS_TYPE, handler=_json_handler)
     def index(self):
-        """Root catalog."""
+        """Root catalog.
+
+        Not ETagged: the bookshelf groups are random samples, so the body
+        differs on every request and could never match.
+        """
 
         def _recently_added():
             result = self.fts.execute(
@@ -309,7 +669,7 @@ class OPDSFeed:
             if result.get("results"):
                 return {
                     "metadata": {"title": "Recently Added", "numberOfItems": result["total"]},
-                    "links": [_link("self", "/opds/search?sort=release_date&sort_order=desc")],
+                    "links": [_RECENT_SELF_LINK],
                     "publications": result["results"],
                 }
 
@@ -321,7 +681,7 @@ class OPDSFeed:
             if result.get("results"):
                 return {
                     "metadata": {"title": "Most Popular", "numberOfItems": result["total"]},
-                    "links": [_link("self", "/opds/search?sort=downloads&sort_order=desc")],
+                    "links": [_POPULAR_SELF_LINK],
                     "publications": result["results"],
                 }
 
@@ -334,7 +694,7 @@ class OPDSFeed:
             if result.get("results"):
                 return {
                     "metadata": {"title": "Audiobooks", "numberOfItems": result["total"]},
-                    "links": [_link("self", "/opds/search?audiobook=true&sort=downloads")],
+                    "links": [_AUDIOBOOKS_SELF_LINK],
                     "publications": result["results"],
                 }
 
@@ -349,11 +709,11 @@ class OPDSFeed:
                     if result.get("results"):
                         return {
                             "metadata": {"title": cat.genre},
-                            "links": [_link("self", f"/opds/bookshelves?category={cat.name}")],
+                            "links": [_CATEGORY_SELF_LINKS[cat.name]],
                             "publications": result["results"],
                         }
                 except Exception as e:
-                    cherrypy.log(f"Index group error ({cat.name}/{shelf_id}): {e}", severity=logging.WARNING)
+                    log.warning("Index group error (%s/%s): %s", cat.name, shelf_id, e)
 
         tasks = [_recently_added, _most_popular, _audiobooks] + [
             lambda c=cat: _category_group(c) for cat in CuratedBookshelves
@@ -368,14 +728,14 @@ class OPDSFeed:
                     if result:
                         groups.append(result)
                 except Exception as e:
-                    cherrypy.log(f"Index group error: {e}")
+                    log.warning("Index group error: %s", e)
 
         return {
             "metadata": {"title": "Project Gutenberg Catalog"},
             "links": [
-                _link("self", "/opds/"),
-                _link("start", "/opds/"),
-                _link("search", "/opds/search{?query}", templated=True),
+                _INDEX_SELF_LINK,
+                _START_LINK,
+                _INDEX_SEARCH_LINK,
             ],
             "navigation": [
                 _nav("/opds/loccs", "Browse Subjects"),
@@ -385,7 +745,8 @@ class OPDSFeed:
 
     # Bookshelves
     @cherrypy.expose
-    @cherrypy.tools.json_out()
+    @cherrypy.tools.json_out(content_type=OPDS_TYPE, handler=_stream_json_handler)
+    @cherrypy.tools.opds_cache()
     def bookshelves(
         self,
         id: Optional[int] = None,
@@ -398,6 +759,7 @@ class OPDSFeed:
         audiobook: str = "",
         sort: str = "",
         sort_order: str = "",
+        cursor: str = "",
     ):
         """Bookshelf navigation."""
         page, limit = _paginate(page, limit)
@@ -413,25 +775,24 @@ class OPDSFeed:
                 audiobook,
                 sort,
                 sort_order,
+                cursor,
             )
         if category is not None:
             return self._bookshelf_category(category)
 
+        cherrypy.response.headers["Cache-Control"] = NAV_CACHE_CONTROL
         return {
             "metadata": {
                 "title": "Bookshelves",
                 "numberOfItems": len(CuratedBookshelves),
             },
             "links": [
-                _link("self", "/opds/bookshelves"),
-                _link("start", "/opds/"),
-                _link("up", "/opds/"),
+                _BOOKSHELVES_SELF_LINK,
+                _START_LINK,
+                _UP_ROOT_LINK,
             ],
             "navigation": [
-                {
-                    **_nav(f"/opds/bookshelves?category={cat.name}", cat.genre),
-                    "properties": {"numberOfItems": len(cat.shelves)},
-                }
+                _counted_nav(_CATEGORY_PREFIX + cat.name, cat.genre, len(cat.shelves))
                 for cat in CuratedBookshelves
             ],
         }
@@ -447,26 +808,41 @@ class OPDSFeed:
         audiobook: str,
         sort: str,
         sort_order: str,
+        cursor: str = "",
     ):
         """Browse books in a bookshelf."""
-        name, parent = f"Bookshelf {shelf_id}", None
-        for cat in CuratedBookshelves:
-            for sid, sname in cat.shelves:
-                if sid == shelf_id:
-                    name, parent = sname, cat.name
-                    break
-            if parent:
-                break
+        version = self._view_version()
+        if sort != OrderBy.RANDOM:
+            self._not_modified(
+                version,
+                (
+                    "bookshelf",
+                    shelf_id,
+                    page,
+                    limit,
+                    query,
+                    lang,
+                    copyrighted,
+                    audiobook,
+                    sort,
+                    sort_order,
+                    cursor,
+                )
+            )
+        name, parent = _SHELF_INDEX.get(shelf_id, (f"Bookshelf {shelf_id}", None))
 
         try:
             q = self.fts.query(crosswalk=Crosswalk.OPDS).bookshelf_id(shelf_id)
             if query.strip():
-                q.search(query, search_type=_search_type("keyword"))
+                q.search(query, search_type=SearchType.FUZZY)
             self._filter(q, lang, copyrighted, audiobook)
+            subjects_q = q.clone_without_sort()
             self._sort(q, sort, sort_order)
+            if cursor:
+                q.after(cursor)
             result = self.fts.execute(q[page, limit])
-        except Exception as e:
-            cherrypy.log(f"Bookshelf error: {e}")
+        except Exception:
+            log.exception("Bookshelf error")
             raise cherrypy.HTTPError(500, "Browse failed")
 
         base = {
@@ -479,14 +855,9 @@ class OPDSFeed:
             "sort_order": sort_order,
         }
         page_url = _make_page_url("/opds/bookshelves", base, query)
-        facet_url = _make_facet_url("/opds/bookshelves", base)
-
-        subjects_q = self.fts.query().bookshelf_id(shelf_id)
-        if query.strip():
-            subjects_q.search(query, search_type=_search_type("keyword"))
-        self._filter(subjects_q, lang, copyrighted, audiobook)
+        facet_prefix = _facet_prefix("/opds/bookshelves", base)
 
-        up = f"/opds/bookshelves?category={parent}" if parent else "/opds/bookshelves"
+        up = _CATEGORY_UP_LINKS[parent] if parent else _UP_BOOKSHELVES_LINK
         feed = {
             "metadata": {
                 "title": name,
@@ -495,77 +866,78 @@ class OPDSFeed:
                 "currentPage": result["page"],
             },
             "links": [
-                _link("self", page_url(result["page"])),
-                _link("start", "/opds/"),
-                _link("up", up),
-                _link(
+                _link("self", page_url(result["page"], cursor)),
+                _START_LINK,
+                up,
+                _templated_link(
                     "search",
-                    f"/opds/bookshelves?id={shelf_id}{{&query}}",
-                    templated=True,
+                    f"{_SHELF_PREFIX}{shelf_id}{{&query}}",
                 ),
             ],
             "publications": result["results"],
-            "facets": self._facets(
-                facet_url,
-                query,
-                lang,
-                copyrighted,
-                audiobook,
-                sort,
-                sort_order,
-                self._top_subjects(subjects_q),
-            ),
         }
-        feed["links"].extend(
-            self._pagination_links(page_url, result["page"], result["total_pages"])
+        self._pagination_links(
+            feed["links"], page_url, result["page"], result["total_pages"], result["next_cursor"]
         )
+        # Facets don't change with the page; send them once, on the first page
+        if result["page"] == 1:
+            subjects = self._top_subjects(
+                subjects_q,
+                ("bookshelf", version, shelf_id, query, lang, copyrighted, audiobook),
+            )
+            if subjects is None:
+                self._incomplete()
+            feed["facets"] = self._facets(
+                facet_prefix, query, lang, copyrighted, audiobook, sort, sort_order, subjects
+            )
         return feed
 
     def _bookshelf_category(self, category: str):
         """List shelves in a category with samples."""
-        found = next((cat for cat in CuratedBookshelves if cat.name == category), None)
+        found = _CATEGORY_INDEX.get(category)
         if not found:
             raise cherrypy.HTTPError(404, "Category not found")
+        # Samples are drawn with ORDER BY RANDOM(); see _opds_cache
+        cherrypy.serving.request.opds_random = True
 
-        shelves = [{"id": s[0], "name": s[1]} for s in found.shelves]
-        groups, counts = [], {}
+        groups = []
 
-        for s in shelves:
-            try:
-                result = self.fts.execute(
-                    self.fts.query(crosswalk=Crosswalk.OPDS)
-                    .bookshelf_id(s["id"])
-                    .order_by(OrderBy.RANDOM)[1, SAMPLE_LIMIT]
+        try:
+            samples = self.fts.sample_bookshelves(
+                [sid for sid, _ in found.shelves], SAMPLE_LIMIT, Crosswalk.OPDS
+            )
+        except Exception as e:
+            log.warning("Bookshelf sample error %s: %s", category, e)
+            samples = {}
+
+        for sid, sname in found.shelves:
+            sample = samples.get(sid)
+            if sample and sample["results"]:
+                groups.append(
+                    {
+                        "metadata": {
+                            "title": sname,
+                            "numberOfItems": sample["total"],
+                        },
+                        "links": [_SHELF_SELF_LINKS[sid]],
+                        "publications": sample["results"],
+                    }
                 )
-                counts[s["id"]] = result.get("total", 0)
-                if result.get("results"):
-                    groups.append(
-                        {
-                            "metadata": {
-                                "title": s["name"],
-                                "numberOfItems": counts[s["id"]],
-                            },
-                            "links": [_link("self", f"/opds/bookshelves?id={s['id']}")],
-                            "publications": result["results"],
-                        }
-                    )
-            except Exception as e:
-                cherrypy.log(f"Bookshelf sample error {s['id']}: {e}", context='OPDS', severity=logging.WARNING)
-                counts[s["id"]] = 0
 
         return {
-            "metadata": {"title": found.genre, "numberOfItems": len(shelves)},
+            "metadata": {"title": found.genre, "numberOfItems": len(found.shelves)},
             "links": [
-                _link("self", f"/opds/bookshelves?category={category}"),
-                _link("start", "/opds/"),
-                _link("up", "/opds/bookshelves"),
+                _CATEGORY_SELF_LINKS[category],
+                _START_LINK,
+                _UP_BOOKSHELVES_LINK,
             ],
             "groups": groups,
         }
 
     # LoCC
     @cherrypy.expose
-    @cherrypy.tools.json_out()
+    @cherrypy.tools.json_out(content_type=OPDS_TYPE, handler=_stream_json_handler)
+    @cherrypy.tools.opds_cache()
     def loccs(
         self,
         parent: str = "",
@@ -577,24 +949,43 @@ class OPDSFeed:
         audiobook: str = "",
         sort: str = "",
         sort_order: str = "",
+        cursor: str = "",
     ):
         """LoCC hierarchical navigation."""
         parent = (parent or "").strip().upper()
         page, limit = _paginate(page, limit)
 
-        try:
-            children = self.fts.get_locc_children(parent)
-        except Exception as e:
-            cherrypy.log(f"LoCC error: {e}")
-            children = []
-
-        if children:
-            return self._locc_navigation(parent, children)
+        nav = self._locc_nav(parent)
+        if nav is not None:
+            cherrypy.response.headers["Cache-Control"] = NAV_CACHE_CONTROL
+            return nav
 
         return self._locc_books(
-            parent, page, limit, query, lang, copyrighted, audiobook, sort, sort_order
+            parent,
+            page,
+            limit,
+            query,
+            lang,
+            copyrighted,
+            audiobook,
+            sort,
+            sort_order,
+            cursor,
         )
 
+    def _locc_nav(self, parent: str) -> Optional[Dict]:
+        """Cached navigation feed for a LoCC code, or None if it is a leaf."""
+        nav = self._locc_nav_cache.get(parent, _MISSING)
+        if nav is _MISSING:
+            try:
+                children = self.fts.get_locc_children(parent)
+            except Exception as e:
+                log.warning("LoCC error: %s", e)
+                return None
+            nav = self._locc_navigation(parent, children) if children else None
+            self._locc_nav_cache.put(parent, nav)
+        return nav
+
     def _locc_navigation(self, parent: str, children: List):
         """Build LoCC category navigation."""
         children.sort(key=lambda x: (len(x.get("code", "")), x.get("code", "")))
@@ -602,37 +993,34 @@ class OPDSFeed:
         # Get parent label from LoCCMainClass if it's a top-level code
         page_title = "Browse Subjects"
         if parent:
-            for item in LoCCMainClass:
-                if item.code == parent:
-                    page_title = item.label
-                    break
-            else:
-                page_title = f"Classification: {parent}"
+            page_title = _LOCC_MAIN_LABELS.get(parent) or f"Classification: {parent}"
+
+        branches = [c["code"] for c in children if c.get("has_children", False)]
+        leaves = [c["code"] for c in children if not c.get("has_children", False)]
+
+        # Branch sizes need one lookup each; overlap them with the leaf count batch
+        with ThreadPoolExecutor(max_workers=LOCC_WORKERS) as executor:
+            leaf_counts = executor.submit(self.fts.get_locc_counts, leaves)
+            branch_counts = executor.map(
+                lambda code: len(self.fts.get_locc_children(code)), branches
+            )
+            counts = dict(zip(branches, branch_counts))
+            counts.update(leaf_counts.result())
 
         nav = []
         for child in children:
             code = child["code"]
             label = child.get("label", code)
             label = label.split(":", 1)[1].strip() if ":" in label else label
-            has_children = child.get("has_children", False)
-
-            if has_children:
-                count = len(self.fts.get_locc_children(code))
-            else:
-                count = self.fts.count(self.fts.query().locc(code))
 
-            nav_item = _nav(f"/opds/loccs?parent={code}", label)
-            nav_item["properties"] = {"numberOfItems": count}
-            nav.append(nav_item)
+            nav.append(_counted_nav(_LOCC_PREFIX + code, label, counts.get(code, 0)))
 
         return {
             "metadata": {"title": page_title, "numberOfItems": len(children)},
             "links": [
-                _link(
-                    "self", f"/opds/loccs?parent={parent}" if parent else "/opds/loccs"
-                ),
-                _link("start", "/opds/"),
-                _link("up", "/opds/loccs" if parent else "/opds/"),
+                _link("self", _LOCC_PREFIX + parent) if parent else _LOCCS_SELF_LINK,
+                _START_LINK,
+                _UP_LOCCS_LINK if parent else _UP_ROOT_LINK,
             ],
             "navigation": nav,
         }
@@ -648,17 +1036,39 @@ class OPDSFeed:
         audiobook: str,
         sort: str,
         sort_order: str,
+        cursor: str = "",
     ):
         """Browse books in a LoCC leaf."""
+        version = self._view_version()
+        if sort != OrderBy.RANDOM:
+            self._not_modified(
+                version,
+                (
+                    "locc",
+                    parent,
+                    page,
+                    limit,
+                    query,
+                    lang,
+                    copyrighted,
+                    audiobook,
+                    sort,
+                    sort_order,
+                    cursor,
+                )
+            )
         try:
             q = self.fts.query(crosswalk=Crosswalk.OPDS).locc(parent)
             if query.strip():
-                q.search(query, search_type=_search_type("keyword"))
+                q.search(query, search_type=SearchType.FUZZY)
             self._filter(q, lang, copyrighted, audiobook)
+            subjects_q = q.clone_without_sort()
             self._sort(q, sort, sort_order)
+            if cursor:
+                q.after(cursor)
             result = self.fts.execute(q[page, limit])
-        except Exception as e:
-            cherrypy.log(f"LoCC browse error: {e}")
+        except Exception:
+            log.exception("LoCC browse error")
             raise cherrypy.HTTPError(500, "Browse failed")
 
         base = {
@@ -671,12 +1081,7 @@ class OPDSFeed:
             "sort_order": sort_order,
         }
         page_url = _make_page_url("/opds/loccs", base, query)
-        facet_url = _make_facet_url("/opds/loccs", base)
-
-        subjects_q = self.fts.query().locc(parent)
-        if query.strip():
-            subjects_q.search(query, search_type=_search_type("keyword"))
-        self._filter(subjects_q, lang, copyrighted, audiobook)
+        facet_prefix = _facet_prefix("/opds/loccs", base)
 
         feed = {
             "metadata": {
@@ -686,34 +1091,34 @@ class OPDSFeed:
                 "currentPage": result["page"],
             },
             "links": [
-                _link("self", page_url(result["page"])),
-                _link("start", "/opds/"),
-                _link("up", "/opds/loccs"),
-                _link(
-                    "search", f"/opds/loccs?parent={parent}{{&query}}", templated=True
+                _link("self", page_url(result["page"], cursor)),
+                _START_LINK,
+                _UP_LOCCS_LINK,
+                _templated_link(
+                    "search", f"{_LOCC_PREFIX}{parent}{{&query}}"
                 ),
             ],
             "publications": result["results"],
-            "facets": self._facets(
-                facet_url,
-                query,
-                lang,
-                copyrighted,
-                audiobook,
-                sort,
-                sort_order,
-                self._top_subjects(subjects_q),
-            ),
         }
-        feed["links"].extend(
-            self._pagination_links(page_url, result["page"], result["total_pages"])
+        self._pagination_links(
+            feed["links"], page_url, result["page"], result["total_pages"], result["next_cursor"]
         )
+        if result["page"] == 1:
+            subjects = self._top_subjects(
+                subjects_q, ("locc", version, parent, query, lang, copyrighted, audiobook)
+            )
+            if subjects is None:
+                self._incomplete()
+            feed["facets"] = self._facets(
+                facet_prefix, query, lang, copyrighted, audiobook, sort, sort_order, subjects
+            )
         return feed
 
     # Subjects
 
     @cherrypy.expose
-    @cherrypy.tools.json_out()
+    @cherrypy.tools.json_out(content_type=OPDS_TYPE, handler=_stream_json_handler)
+    @cherrypy.tools.opds_cache()
     def subjects(
         self,
         id: Optional[int] = None,
@@ -725,6 +1130,7 @@ class OPDSFeed:
         audiobook: str = "",
         sort: str = "",
         sort_order: str = "",
+        cursor: str = "",
     ):
         """Subject navigation."""
         page, limit = _paginate(page, limit)
@@ -740,23 +1146,22 @@ class OPDSFeed:
                 audiobook,
                 sort,
                 sort_order,
+                cursor,
             )
 
         subjects = sorted(
             self.fts.list_subjects(), key=lambda x: x["book_count"], reverse=True
         )
+        cherrypy.response.headers["Cache-Control"] = NAV_CACHE_CONTROL
         return {
             "metadata": {"title": "Subjects", "numberOfItems": len(subjects)},
             "links": [
-                _link("self", "/opds/subjects"),
-                _link("start", "/opds/"),
-                _link("up", "/opds/"),
+                _SUBJECTS_SELF_LINK,
+                _START_LINK,
+                _UP_ROOT_LINK,
             ],
             "navigation": [
-                {
-                    **_nav(f"/opds/subjects?id={s['id']}", s["name"]),
-                    "properties": {"numberOfItems": s["book_count"]},
-                }
+                _counted_nav(f"{_SUBJECT_PREFIX}{s['id']}", s["name"], s["book_count"])
                 for s in subjects[:100]
             ],
         }
@@ -772,19 +1177,47 @@ class OPDSFeed:
         audiobook: str,
         sort: str,
         sort_order: str,
+        cursor: str = "",
+        conditional: bool = True,
     ):
-        """Browse books for a subject."""
+        """Browse books for a subject.
+
+        conditional=False skips the If-None-Match check, for use outside requests.
+        """
+        version = self._view_version()
+        key = (
+            "subject",
+            version,
+            subject_id,
+            page,
+            limit,
+            query,
+            lang,
+            copyrighted,
+            audiobook,
+            sort,
+            sort_order,
+            cursor,
+        )
+        if conditional and sort != OrderBy.RANDOM:
+            self._not_modified(version, key)
+        body = self._feed_cache.get(key)
+        if body is not None:
+            return body
+
         name = self.fts.get_subject_name(subject_id) or f"Subject {subject_id}"
 
         try:
             q = self.fts.query(crosswalk=Crosswalk.OPDS).subject_id(subject_id)
             if query.strip():
-                q.search(query, search_type=_search_type("keyword"))
+                q.search(query, search_type=SearchType.FUZZY)
             self._filter(q, lang, copyrighted, audiobook)
             self._sort(q, sort, sort_order)
+            if cursor:
+                q.after(cursor)
             result = self.fts.execute(q[page, limit])
-        except Exception as e:
-            cherrypy.log(f"Subject error: {e}")
+        except Exception:
+            log.exception("Subject error")
             raise cherrypy.HTTPError(500, "Browse failed")
 
         base = {
@@ -797,7 +1230,7 @@ class OPDSFeed:
             "sort_order": sort_order,
         }
         page_url = _make_page_url("/opds/subjects", base, query)
-        facet_url = _make_facet_url("/opds/subjects", base)
+        facet_prefix = _facet_prefix("/opds/subjects", base)
 
         feed = {
             "metadata": {
@@ -807,29 +1240,34 @@ class OPDSFeed:
                 "currentPage": result["page"],
             },
             "links": [
-                _link("self", page_url(result["page"])),
-                _link("start", "/opds/"),
-                _link("up", "/opds/subjects"),
-                _link(
+                _link("self", page_url(result["page"], cursor)),
+                _START_LINK,
+                _UP_SUBJECTS_LINK,
+                _templated_link(
                     "search",
-                    f"/opds/subjects?id={subject_id}{{&query}}",
-                    templated=True,
+                    f"{_SUBJECT_PREFIX}{subject_id}{{&query}}",
                 ),
             ],
             "publications": result["results"],
-            "facets": self._facets(
-                facet_url, query, lang, copyrighted, audiobook, sort, sort_order
-            ),
         }
-        feed["links"].extend(
-            self._pagination_links(page_url, result["page"], result["total_pages"])
+        self._pagination_links(
+            feed["links"], page_url, result["page"], result["total_pages"], result["next_cursor"]
         )
-        return feed
+        if result["page"] == 1:
+            feed["facets"] = self._facets(
+                facet_prefix, query, lang, copyrighted, audiobook, sort, sort_order
+            )
+        # Random order must differ per request
+        if sort == OrderBy.RANDOM:
+            return feed
+        body = _feed_body(feed)
+        self._feed_cache.put(key, body)
+        return body
 
     # Search
 
     @cherrypy.expose
-    @cherrypy.tools.json_out()
+    @cherrypy.tools.json_out(content_type=OPDS_TYPE, handler=_stream_json_handler)
     def search(
         self,
         query: str = "",
@@ -846,6 +1284,28 @@ class OPDSFeed:
     ):
         """Full-text search."""
         page, limit = _paginate(page, limit)
+        version = self._view_version()
+        key = (
+            "search",
+            version,
+            query,
+            page,
+            limit,
+            field,
+            lang,
+            copyrighted,
+            audiobook,
+            sort,
+            sort_order,
+            locc,
+            author_id,
+        )
+        if sort != OrderBy.RANDOM:
+            self._not_modified(version, key)
+        body = self._feed_cache.get(key)
+        if body is not None:
+            return body
+
         stype = _search_type(field)
 
         try:
@@ -857,20 +1317,28 @@ class OPDSFeed:
             if author_id is not None:
                 q.author_id(int(author_id))
             self._filter(q, lang, copyrighted, audiobook)
+
+            # Aggregate top subjects on a pool thread while this one runs the page
+            # query, unless another page of this search already did
+            subjects = subjects_future = None
+            with_subjects = bool(query.strip() or locc or lang)
+            if with_subjects:
+                subjects_key = (
+                    "search", version, query, stype, locc, author_id, lang, copyrighted,
+                    audiobook,
+                )
+                subjects = self._subjects_cache.get(subjects_key)
+                if subjects is None:
+                    subjects_future = self._executor.submit(
+                        self._top_subjects, q.clone_without_sort(), subjects_key
+                    )
             self._sort(q, sort, sort_order)
-            result = self.fts.execute(q[page, limit])
 
-            subjects = None
-            if query.strip() or locc or lang:
-                sq = self.fts.query()
-                if query.strip():
-                    sq.search(query, search_type=stype)
-                if locc:
-                    sq.locc(locc)
-                self._filter(sq, lang, copyrighted, audiobook)
-                subjects = self._top_subjects(sq)
-        except Exception as e:
-            cherrypy.log(f"Search error: {e}")
+            result = self.fts.execute(q[page, limit])
+            if subjects_future:
+                subjects = subjects_future.result()
+        except Exception:
+            log.exception("Search error")
             raise cherrypy.HTTPError(500, "Search failed")
 
         base = {
@@ -885,10 +1353,10 @@ class OPDSFeed:
             "author_id": author_id,
         }
         page_url = _make_page_url("/opds/search", base, query)
-        facet_url = _make_facet_url("/opds/search", base)
+        facet_prefix = _facet_prefix("/opds/search", base)
 
         facets = self._facets(
-            facet_url, query, lang, copyrighted, audiobook, sort, sort_order, subjects
+            facet_prefix, query, lang, copyrighted, audiobook, sort, sort_order, subjects
         )
 
         feed = {
@@ -900,19 +1368,24 @@ class OPDSFeed:
             },
             "links": [
                 _link("self", page_url(result["page"])),
-                _link("start", "/opds/"),
-                _link("up", "/opds/"),
-                _link(
-                    "search", f"/opds/search?field={field}{{&query}}", templated=True
+                _START_LINK,
+                _UP_ROOT_LINK,
+                _templated_link(
+                    "search", f"/opds/search?field={field}{{&query}}"
                 ),
             ],
             "publications": result["results"],
             "facets": facets,
         }
-        feed["links"].extend(
-            self._pagination_links(page_url, result["page"], result["total_pages"])
-        )
-        return feed
+        self._pagination_links(feed["links"], page_url, result["page"], result["total_pages"])
+        if with_subjects and subjects is None:
+            self._incomplete()
+            return feed
+        if sort == OrderBy.RANDOM:
+            return feed
+        body = _feed_body(feed)
+        self._feed_cache.put(key, body)
+        return body
 
 
 if __name__ == "__main__":
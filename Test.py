@@ -2,10 +2,17 @@
 run this with
 python -m unittest -v Test
 '''
+import base64
+import collections
+import json
 import os
 import unittest
+from urllib.parse import urlencode
 
 import CherryPyApp
+import OPDS2
+from mv_search.constants import Language, OrderBy, SortDirection
+from mv_search.Search import SearchQuery
 
 class TestInstantiation(unittest.TestCase):
     def setUp(self):
@@ -16,3 +23,148 @@ class TestInstantiation(unittest.TestCase):
 
     def test_main(self):
         CherryPyApp.main()
+
+
+Row = collections.namedtuple('Row', 'sort_key book_id')
+
+
+def encode_cursor(payload):
+    return base64.urlsafe_b64encode(json.dumps(payload).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+class TestKeysetCursor(unittest.TestCase):
+    def query(self, order=OrderBy.DOWNLOADS, direction=None):
+        return SearchQuery().order_by(order, direction)
+
+    def test_round_trip(self):
+        cursor = self.query()._next_cursor(Row(120, 7), 300)
+        q = self.query().after(cursor)
+        self.assertEqual(q._after, (OrderBy.DOWNLOADS, SortDirection.DESC, 120, 7))
+        self.assertEqual(q._after_total, 300)
+        sql, params = q.build()
+        self.assertIn('downloads < :ks_key OR (downloads = :ks_key AND book_id < :ks_id)', sql)
+        self.assertNotIn('IS NULL', sql)
+        self.assertNotIn('total_count', sql)
+        self.assertEqual((params['ks_key'], params['ks_id'], params['offset']), (120, 7, 0))
+
+    def test_nulls_last_key(self):
+        cursor = self.query(OrderBy.RELEASE_DATE)._next_cursor(Row('2020-01-01', 7), 300)
+        sql, params = self.query(OrderBy.RELEASE_DATE).after(cursor).build()
+        self.assertIn('OR CAST(release_date AS date) IS NULL', sql)
+        self.assertEqual(params['ks_key'], '2020-01-01')
+
+    def test_nulls_last_tail(self):
+        cursor = self.query(OrderBy.AUTHOR)._next_cursor(Row(None, 7), 300)
+        sql, params = self.query(OrderBy.AUTHOR).after(cursor).build()
+        self.assertIn('(creator_names[1] IS NULL AND book_id > :ks_id)', sql)
+        self.assertNotIn('ks_key', params)
+
+    def test_null_key_without_nulls_last(self):
+        # downloads DESC sorts NULLs first; a cursor cannot start in that head
+        self.assertIsNone(self.query()._next_cursor(Row(None, 7), 300))
+
+    def test_default_nulls_last(self):
+        # ASC without a NULLS clause: Postgres sorts NULLs last
+        for order, direction, key in ((OrderBy.TITLE, None, 'A'),
+                                      (OrderBy.DOWNLOADS, SortDirection.ASC, 5)):
+            cursor = self.query(order, direction)._next_cursor(Row(key, 7), 300)
+            sql = self.query(order, direction).after(cursor).build()[0]
+            self.assertIn('OR {} IS NULL'.format(order.value), sql)
+            cursor = self.query(order, direction)._next_cursor(Row(None, 7), 300)
+            self.assertIsNotNone(cursor)
+            sql = self.query(order, direction).after(cursor).build()[0]
+            self.assertIn('({} IS NULL AND book_id > :ks_id)'.format(order.value), sql)
+
+    def test_no_cursor_for_random(self):
+        self.assertIsNone(self.query(OrderBy.RANDOM)._next_cursor(Row(1, 7), 300))
+
+    def assertFallsBack(self, q):
+        self.assertFalse(q._uses_cursor())
+        sql, params = q[3].build()
+        self.assertNotIn('ks_id', params)
+        self.assertEqual(params['offset'], 50)
+
+    def test_inline_count(self):
+        self.assertNotIn('total_count', self.query().build()[0])
+        self.assertFalse(self.query()._counts_inline())
+        q = self.query().lang('en')
+        self.assertIn('COUNT(*) OVER ()', q.build()[0])
+        self.assertTrue(q._counts_inline())
+        cursor = self.query()._next_cursor(Row(120, 7), 300)
+        self.assertFalse(self.query().lang('en').after(cursor)._counts_inline())
+
+    def test_garbage_cursor(self):
+        for cursor in ('', 'not-base64!', encode_cursor({'a': 1}), encode_cursor([1, 2])):
+            q = self.query().after(cursor)
+            self.assertIsNone(q._after)
+            self.assertFallsBack(q)
+
+    def test_non_scalar_key(self):
+        cursors = [['downloads', 'desc', key, 7, 300] for key in ([1], {'a': 1}, True, 'abc')]
+        cursors += [
+            ['title', 'asc', 5, 7, 10],
+            ['release_date', 'desc', 'abc', 7, 10],
+            ['downloads', 'desc', 1, float('inf')],
+            ['downloads', 'desc', 1, 7, float('inf')],
+            ['downloads', 'desc', float('nan'), 7, 10],
+        ]
+        for payload in cursors:
+            q = self.query(OrderBy(payload[0])).after(encode_cursor(payload))
+            self.assertIsNone(q._after, payload)
+            self.assertFallsBack(q)
+
+    def test_other_sort(self):
+        cursor = self.query(OrderBy.TITLE)._next_cursor(Row('A', 7), 300)
+        self.assertFallsBack(self.query().after(cursor))
+        self.assertFallsBack(self.query(OrderBy.TITLE, SortDirection.DESC).after(cursor))
+
+    def test_null_key_in_nulls_first_head(self):
+        self.assertFallsBack(self.query().after(encode_cursor(['downloads', 'desc', None, 7, 300])))
+
+    def test_cursor_without_total(self):
+        q = self.query().after(encode_cursor(['downloads', 'desc', 120, 7]))
+        self.assertIsNotNone(q._after)
+        self.assertIsNone(q._after_total)
+
+
+class TestOPDSHelpers(unittest.TestCase):
+    def test_language_facet_links(self):
+        language = OPDS2._filter_facets('/opds/search?', 'cats', 'fr', '', 'true', '', '')[3]
+        self.assertEqual(language['metadata'], {'title': 'Language'})
+        links = language['links']
+        self.assertEqual(len(links), len(Language) + 1)
+        for link in links:
+            self.assertIsInstance(link, dict)
+            self.assertEqual(link['type'], OPDS2.OPDS_TYPE)
+        self.assertEqual(links[0]['title'], 'Any')
+        self.assertEqual(links[0]['href'], '/opds/search?query=cats&page=1&audiobook=true')
+        self.assertEqual([l['title'] for l in links if l.get('rel') == 'self'], ['French'])
+        self.assertIn('/opds/search?query=cats&page=1&lang=en&audiobook=true',
+                      [l['href'] for l in links])
+
+    def test_query_string(self):
+        params = {'id': 5, 'query': 'a b&c/ü', 'lang': '', 'page': None,
+                  'sort': 'title', 'tags': ['x y', 'z']}
+        expected = urlencode({k: v for k, v in params.items() if v not in ('', None)}, doseq=True)
+        self.assertEqual(OPDS2._query_string(params), expected)
+        self.assertEqual(OPDS2._query_string({'lang': ''}), '')
+
+    def test_iter_feed(self):
+        publications = [{'metadata': {'title': 't%d' % i}} for i in range(OPDS2.STREAM_BATCH * 2 + 3)]
+        feed = {'metadata': {'title': 'ü'}, 'links': [], 'publications': publications}
+        self.assertEqual(json.loads(b''.join(OPDS2._iter_feed(feed))), feed)
+
+        facets = [{'metadata': {'title': 'Sort By'}, 'links': []}]
+        body = b''.join(OPDS2._iter_feed(dict(feed, facets=OPDS2._dumps(facets))))
+        self.assertEqual(json.loads(body), dict(feed, facets=facets))
+
+        self.assertEqual(json.loads(b''.join(OPDS2._iter_feed({'publications': []}))),
+                         {'publications': []})
+
+    def test_as_int(self):
+        self.assertEqual(OPDS2._as_int('42', 1), 42)
+        self.assertEqual(OPDS2._as_int(7, 1), 7)
+        for value in ('', None, '-3', '2.5', ' 4', 'abc', '9' * 10, True, 3.0):
+            self.assertEqual(OPDS2._as_int(value, 1), 1, value)
+        self.assertEqual(OPDS2._paginate('0', '500'), (1, 100))
+        self.assertEqual(OPDS2._paginate('x', None), (1, 25))
@@ -37,15 +37,22 @@ class TimerPlugin (cherrypy.process.plugins.Monitor):
 
     """
 
-    def __init__ (self, bus):
+    def __init__ (self, bus, refresh_on_start=True):
         frequency = 300
         super (TimerPlugin, self).__init__ (bus, self.tick, frequency)
         self.name = 'timer'
         self._last_refresh_date = None
+        # A WSGI worker must not refresh inside start (), it would not boot
+        # before the server's timeout; the first tick of the thread does it.
+        self.refresh_on_start = refresh_on_start
+        self._startup_pending = False
 
     def start (self):
         super (TimerPlugin, self).start ()
-        self.tick (startup=True)
+        if self.refresh_on_start:
+            self.tick (startup=True)
+        else:
+            self._startup_pending = True
     start.priority = 80
 
     def tick (self, startup=False):
@@ -59,7 +66,9 @@ class TimerPlugin (cherrypy.process.plugins.Monitor):
         refresh_hour = cherrypy.config.get ('mv_refresh_hour', 17)
         now = datetime.datetime.now ()
 
-        if startup or (now.hour == refresh_hour and self._last_refresh_date != now.date ()):
+        if startup or self._startup_pending or (
+                now.hour == refresh_hour and self._last_refresh_date != now.date ()):
+            self._startup_pending = False
             self._try_refresh_mv ()
 
     def _try_refresh_mv (self):
@@ -69,6 +78,10 @@ class TimerPlugin (cherrypy.process.plugins.Monitor):
 
         Bypasses the pool to avoid statement timeout errors.
         pguser needs EXECUTE on refresh_mv_books_dc() and ownership of mv_books_dc.
+
+        Each refresh stamps the view's comment with the time it ran, so
+        an instance that waited for another can tell whether that refresh
+        actually committed.
         """
         conn = None
         try:
@@ -76,19 +89,39 @@ class TimerPlugin (cherrypy.process.plugins.Monitor):
             conn = psycopg2.connect (**params)
             cur = conn.cursor ()
 
-            # Transaction-level advisory lock keyed on the view's OID.
-            # Auto-releases on commit/rollback — no explicit unlock needed.
             cur.execute ("""
-                SELECT pg_try_advisory_xact_lock(c.oid::bigint)
+                SELECT c.oid::bigint, obj_description(c.oid, 'pg_class')
                 FROM pg_class c WHERE c.relname = 'mv_books_dc'
             """)
-            if not cur.fetchone ()[0]:
-                return
+            oid, stamp = cur.fetchone ()
 
-            cur.execute ("SELECT refresh_mv_books_dc()")
-            conn.commit ()
+            # Transaction-level advisory lock keyed on the view's OID.
+            # Auto-releases on commit/rollback — no explicit unlock needed.
+            cur.execute ("SELECT pg_try_advisory_xact_lock(%s)", (oid, ))
+            if cur.fetchone ()[0]:
+                cur.execute ("SELECT refresh_mv_books_dc(), CAST(now() AS text)")
+                cur.execute ("COMMENT ON MATERIALIZED VIEW mv_books_dc IS %s",
+                             (cur.fetchone ()[1], ))
+                conn.commit ()
+                cherrypy.log ("MV refresh completed.", context='TIMER', severity=logging.INFO)
+            else:
+                # Another instance (e.g. a sibling worker process) is refreshing.
+                # Wait for it to finish instead of refreshing again, but not
+                # forever: on timeout this fails and the next tick retries.
+                wait = cherrypy.config.get ('mv_refresh_wait', 1800)
+                cur.execute ("SET LOCAL lock_timeout = %s", ('%ds' % wait, ))
+                cur.execute ("SELECT pg_advisory_xact_lock(%s)", (oid, ))
+                cur.execute ("SELECT obj_description(%s::oid, 'pg_class')", (oid, ))
+                refreshed = cur.fetchone ()[0] != stamp
+                conn.rollback ()
+                if not refreshed:
+                    cherrypy.log ("MV refresh by another instance did not complete.",
+                                  context='TIMER', severity=logging.WARNING)
+                    return
+                cherrypy.log ("MV refreshed by another instance.", context='TIMER', severity=logging.INFO)
             self._last_refresh_date = datetime.date.today ()
-            cherrypy.log ("MV refresh completed.", context='TIMER', severity=logging.INFO)
+            # let caches built on the old view contents drop them
+            self.bus.publish ('mv_refresh')
         except Exception as e:
             cherrypy.log ("MV refresh failed: %s" % e, context='TIMER', severity=logging.ERROR)
         finally:
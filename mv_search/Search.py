@@ -4,6 +4,11 @@ Search.py — Zachary Rosario
 Query builder and search interface for the mv_books_dc materialized view.
 """
 
+import base64
+import datetime
+import functools
+import json
+import math
 from typing import Dict, List, Optional, Tuple, Union
 
 from sqlalchemy import text
@@ -36,6 +41,39 @@ _ORDER_COLUMNS = {
     OrderBy.RELEASE_DATE: ("CAST(release_date AS date)", SortDirection.DESC, "LAST"),
     OrderBy.RANDOM: ("RANDOM()", None, None),
 }
+# Built SQL only varies with the query's shape (values are bound), so parse each once
+_text = functools.lru_cache(maxsize=512)(text)
+# (code, label) of the LoCC main classes, by code
+_LOCC_MAIN = tuple(
+    (item.code, item.label) for item in sorted(LoCCMainClass, key=lambda x: x.code)
+)
+# Orders that can be paged with a cursor, i.e. have a real sort column,
+# and the JSON type of the sort key their cursors carry
+_KEYSET_ORDERS = {
+    OrderBy.DOWNLOADS: (int, float),
+    OrderBy.TITLE: str,
+    OrderBy.AUTHOR: str,
+    OrderBy.RELEASE_DATE: str,
+}
+
+
+def _valid_key(order: OrderBy, key: object) -> bool:
+    """Whether a decoded cursor key can be bound against order's sort column."""
+    if key is None:
+        return True
+    # bool is an int, but not a download count
+    if isinstance(key, bool) or not isinstance(key, _KEYSET_ORDERS.get(order, ())):
+        return False
+    if isinstance(key, float):
+        return math.isfinite(key)
+    if order == OrderBy.RELEASE_DATE:
+        try:
+            datetime.datetime.strptime(key, "%Y-%m-%d")
+        except ValueError:
+            return False
+    return True
+
+
 _SELECT = (
     "book_id, title, downloads, CAST(release_date AS text) AS release_date, copyrighted, lang_codes, "
     "creator_ids, creator_names, creator_roles, "
@@ -74,6 +112,8 @@ class SearchQuery:
         self._page_size = 25
         self._crosswalk = Crosswalk.PG
         self._param_counter = 0
+        self._after = None  # type: Optional[Tuple]
+        self._after_total = None  # type: Optional[int]
 
     def __getitem__(self, key: Union[int, Tuple]) -> "SearchQuery":
         """Set pagination: q[3] for page 3, q[2, 50] for page 2 with 50 results."""
@@ -84,10 +124,40 @@ class SearchQuery:
             self._page = max(1, int(key))
         return self
 
+    def after(self, cursor: str) -> "SearchQuery":
+        """Continue after the row a cursor from execute()["next_cursor"] points at.
+
+        The page is then fetched by keyset instead of OFFSET. Cursors that do
+        not decode, carry a key of the wrong type for their sort, or were made
+        for another sort, are ignored so the query falls back to plain page
+        numbers. The cursor also carries the result total, so keyset pages
+        need no count query.
+        """
+        try:
+            padded = cursor + "=" * (-len(cursor) % 4)
+            order, direction, key, book_id, *total = json.loads(base64.urlsafe_b64decode(padded))
+            order = OrderBy(order)
+            if not _valid_key(order, key):
+                raise TypeError("cursor key")
+            self._after = (order, SortDirection(direction), key, int(book_id))
+            self._after_total = max(0, int(total[0])) if total else None
+        except (ValueError, TypeError, OverflowError):
+            self._after = self._after_total = None
+        return self
+
     def crosswalk(self, cw: Crosswalk) -> "SearchQuery":
         self._crosswalk = cw
         return self
 
+    def clone_without_sort(self) -> "SearchQuery":
+        """Copy search terms and filters, leaving order, cursor and page at defaults."""
+        clone = SearchQuery()
+        clone._search = list(self._search)
+        clone._filters = list(self._filters)
+        clone._crosswalk = self._crosswalk
+        clone._param_counter = self._param_counter
+        return clone
+
     def order_by(
         self, order: OrderBy, direction: Optional[SortDirection] = None
     ) -> "SearchQuery":
@@ -251,13 +321,18 @@ class SearchQuery:
 
     # === SQL Building ===
 
-    def _params(self) -> Dict[str, object]:
-        params = {}
-        for _, p, *_ in self._search:
+    def _clauses(self) -> Tuple[Dict[str, object], Optional[str], List[str]]:
+        """Bound params, joined search predicate and filter predicates, in one pass."""
+        params = {}  # type: Dict[str, object]
+        search = []  # type: List[str]
+        for sql, p, _ in self._search:
+            search.append(sql)
             params.update(p)
-        for _, p in self._filters:
+        filters = []  # type: List[str]
+        for sql, p in self._filters:
+            filters.append(sql)
             params.update(p)
-        return params
+        return params, " AND ".join(search) or None, filters
 
     def _order_sql(self, params: Dict) -> str:
         if self._order == OrderBy.RELEVANCE and self._search:
@@ -279,39 +354,116 @@ class SearchQuery:
         clause = "{} {}".format(col, direction.value.upper())
         if nulls:
             clause += " NULLS {}".format(nulls)
+        if self._order in _KEYSET_ORDERS:
+            # Tie-break on book_id so the order is total and cursors are exact
+            clause += ", book_id {}".format(direction.value.upper())
         return clause
 
+    def _keyset(self) -> Optional[Tuple[str, SortDirection, str]]:
+        """Sort column, direction and NULLS placement if this query can use a cursor.
+
+        Without an explicit NULLS clause Postgres sorts NULLs last for ASC and
+        first for DESC; the placement returned is the effective one.
+        """
+        if self._order not in _KEYSET_ORDERS:
+            return None
+        col, default_dir, nulls = _ORDER_COLUMNS[self._order]
+        direction = self._sort_dir or default_dir
+        if nulls is None:
+            nulls = "LAST" if direction == SortDirection.ASC else "FIRST"
+        return col, direction, nulls
+
+    def _keyset_sql(self, params: Dict) -> Optional[str]:
+        """WHERE fragment selecting the rows after the cursor, if one applies."""
+        keyset = self._keyset()
+        if not self._after or not keyset:
+            return None
+        col, direction, nulls = keyset
+        order, cursor_dir, key, book_id = self._after
+        if order != self._order or cursor_dir != direction:
+            return None
+
+        if key is None and nulls != "LAST":
+            # _next_cursor never starts a cursor in a NULLS FIRST head
+            return None
+
+        op = ">" if direction == SortDirection.ASC else "<"
+        params["ks_id"] = book_id
+        if key is None:
+            # Already in the NULLS LAST tail; only book_id moves forward
+            return "({} IS NULL AND book_id {} :ks_id)".format(col, op)
+        params["ks_key"] = key
+        sql = "{0} {1} :ks_key OR ({0} = :ks_key AND book_id {1} :ks_id)".format(col, op)
+        if nulls == "LAST":
+            sql += " OR {} IS NULL".format(col)
+        return "({})".format(sql)
+
+    def _uses_cursor(self) -> bool:
+        return self._keyset_sql({}) is not None
+
+    def _counts_inline(self) -> bool:
+        """Whether build() returns the result total with the page.
+
+        COUNT(*) OVER () makes Postgres buffer every matching row before the
+        top-N sort, so unfiltered queries, which match the whole view, keep
+        the separate build_count() query. A cursor page only sees later rows.
+        """
+        return bool(self._search or self._filters) and not self._uses_cursor()
+
+    def _next_cursor(self, row, total: int) -> Optional[str]:
+        """Cursor pointing just past row, the last row of a fetched page of total results."""
+        keyset = self._keyset()
+        if not keyset:
+            return None
+        key = row.sort_key
+        if key is None and keyset[2] != "LAST":
+            return None
+        if key is not None and not isinstance(key, (int, float, str)):
+            key = str(key)
+        payload = json.dumps([self._order.value, keyset[1].value, key, row.book_id, total])
+        return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii").rstrip("=")
+
     def build(self) -> Tuple[str, Dict]:
-        params = self._params()
+        params, search_sql, filters = self._clauses()
         order = self._order_sql(params)
-        limit, offset = self._page_size, (self._page - 1) * self._page_size
-
-        search_sql = " AND ".join(s[0] for s in self._search) if self._search else None
-        filter_sql = " AND ".join(f[0] for f in self._filters) if self._filters else None
+        keyset_sql = self._keyset_sql(params)
+        params["limit"] = self._page_size
+        params["offset"] = 0 if keyset_sql else (self._page - 1) * self._page_size
+
+        select = _SELECT
+        keyset = self._keyset()
+        if keyset:
+            select += ", {} AS sort_key".format(keyset[0])
+        if not keyset_sql and (search_sql or filters):
+            # Total rides along with the page, see _counts_inline
+            select += ", COUNT(*) OVER () AS total_count"
+
+        if keyset_sql:
+            filters.append(keyset_sql)
+        filter_sql = " AND ".join(filters) or None
 
         if search_sql and filter_sql:
-            sql = "SELECT {} FROM (SELECT {} FROM mv_books_dc WHERE {}) t WHERE {} ORDER BY {} LIMIT {} OFFSET {}".format(
-                _SELECT, _SUBQUERY, search_sql, filter_sql, order, limit, offset
+            sql = "SELECT {} FROM (SELECT {} FROM mv_books_dc WHERE {}) t WHERE {} ORDER BY {} LIMIT :limit OFFSET :offset".format(
+                select, _SUBQUERY, search_sql, filter_sql, order
             )
         elif search_sql:
-            sql = "SELECT {} FROM mv_books_dc WHERE {} ORDER BY {} LIMIT {} OFFSET {}".format(
-                _SELECT, search_sql, order, limit, offset
+            sql = "SELECT {} FROM mv_books_dc WHERE {} ORDER BY {} LIMIT :limit OFFSET :offset".format(
+                select, search_sql, order
             )
         elif filter_sql:
-            sql = "SELECT {} FROM mv_books_dc WHERE {} ORDER BY {} LIMIT {} OFFSET {}".format(
-                _SELECT, filter_sql, order, limit, offset
+            sql = "SELECT {} FROM mv_books_dc WHERE {} ORDER BY {} LIMIT :limit OFFSET :offset".format(
+                select, filter_sql, order
             )
         else:
-            sql = "SELECT {} FROM mv_books_dc ORDER BY {} LIMIT {} OFFSET {}".format(
-                _SELECT, order, limit, offset
+            sql = "SELECT {} FROM mv_books_dc ORDER BY {} LIMIT :limit OFFSET :offset".format(
+                select, order
             )
 
         return sql, params
 
     def build_count(self) -> Tuple[str, Dict]:
-        params = self._params()
-        search_sql = " AND ".join(s[0] for s in self._search) if self._search else None
-        filter_sql = " AND ".join(f[0] for f in self._filters) if self._filters else None
+        params, search_sql, filters = self._clauses()
+        filter_sql = " AND ".join(filters) or None
 
         if search_sql and filter_sql:
             return (
@@ -351,13 +503,33 @@ class FullTextSearch:
     def execute(self, q: "SearchQuery") -> Dict:
         """Execute query and return paginated results."""
         with self.Session() as session:
-            count_sql, count_params = q.build_count()
-            total = session.execute(text(count_sql), count_params).scalar() or 0
+            cursor_page = q._uses_cursor()
+            inline_count = q._counts_inline()
+            sql, params = q.build()
+            rows = session.execute(_text(sql), params).fetchall()
+
+            if rows and inline_count:
+                total = rows[0].total_count
+            elif q._page == 1 and inline_count:
+                total = 0
+            elif cursor_page and q._after_total is not None:
+                total = q._after_total
+            else:
+                # Unfiltered queries, pages past the end and cursors without
+                # a total need their own count
+                count_sql, count_params = q.build_count()
+                total = session.execute(_text(count_sql), count_params).scalar() or 0
+
             total_pages = max(1, (total + q._page_size - 1) // q._page_size)
-            q._page = max(1, min(q._page, total_pages))
+            if q._page > total_pages:
+                q._page = total_pages
+                if total and not cursor_page:
+                    sql, params = q.build()
+                    rows = session.execute(_text(sql), params).fetchall()
 
-            sql, params = q.build()
-            rows = session.execute(text(sql), params).fetchall()
+        next_cursor = None
+        if rows and len(rows) == q._page_size and q._page < total_pages:
+            next_cursor = q._next_cursor(rows[-1], total)
 
         return {
             "results": [self._transform(r, q._crosswalk) for r in rows],
@@ -365,13 +537,85 @@ class FullTextSearch:
             "page_size": q._page_size,
             "total": total,
             "total_pages": total_pages,
+            "next_cursor": next_cursor,
         }
 
     def count(self, q: "SearchQuery") -> int:
         """Count results without fetching."""
         with self.Session() as session:
             sql, params = q.build_count()
-            return session.execute(text(sql), params).scalar() or 0
+            return session.execute(_text(sql), params).scalar() or 0
+
+    def sample_bookshelves(
+        self, shelf_ids: List[int], limit: int = 15, crosswalk: Crosswalk = Crosswalk.PG
+    ) -> Dict[int, Dict]:
+        """
+        Fetch a random sample of books from several bookshelves in one query.
+
+        Args:
+            shelf_ids: Bookshelf primary keys
+            limit: Maximum number of books per shelf (default 15)
+            crosswalk: Output format for the sampled books
+
+        Returns:
+            Dict mapping each shelf id to a dict with 'results' and 'total' keys
+        """
+        shelf_ids = [int(sid) for sid in shelf_ids]
+        if not shelf_ids:
+            return {}
+        limit = max(1, min(100, int(limit)))
+
+        sql = text("""
+            SELECT * FROM (
+                SELECT mbb.fk_bookshelves AS shelf_id, {},
+                    ROW_NUMBER() OVER (PARTITION BY mbb.fk_bookshelves ORDER BY RANDOM()) AS rn,
+                    COUNT(*) OVER (PARTITION BY mbb.fk_bookshelves) AS shelf_total
+                FROM mv_books_dc
+                JOIN mn_books_bookshelves mbb ON mbb.fk_books = book_id
+                WHERE mbb.fk_bookshelves = ANY(:ids)
+            ) t
+            WHERE rn <= :limit
+        """.format(_SELECT))
+
+        with self.Session() as session:
+            rows = session.execute(sql, {"ids": shelf_ids, "limit": limit}).fetchall()
+
+        samples = {sid: {"results": [], "total": 0} for sid in shelf_ids}
+        for r in rows:
+            sample = samples[r.shelf_id]
+            sample["total"] = r.shelf_total
+            sample["results"].append(self._transform(r, crosswalk))
+        return samples
+
+    def get_locc_counts(self, codes: List[str]) -> Dict[str, int]:
+        """
+        Count books under several LoCC codes in a single query.
+
+        Uses the same prefix match as SearchQuery.locc().
+
+        Args:
+            codes: LoCC codes to count
+
+        Returns:
+            Dict mapping each code to its book count (0 if none)
+        """
+        codes = [str(c).upper() for c in codes]
+        if not codes:
+            return {}
+
+        sql = text("""
+            SELECT c.code, COUNT(DISTINCT mbl.fk_books) AS book_count
+            FROM unnest(CAST(:codes AS text[])) AS c(code)
+            JOIN mn_books_loccs mbl ON mbl.fk_loccs LIKE c.code || '%'
+            JOIN mv_books_dc mv ON mv.book_id = mbl.fk_books
+            GROUP BY c.code
+        """)
+
+        with self.Session() as session:
+            rows = session.execute(sql, {"codes": codes}).fetchall()
+        counts = dict.fromkeys(codes, 0)
+        counts.update((r.code, r.book_count) for r in rows)
+        return counts
 
     def list_bookshelves(self) -> List[Dict]:
         """
@@ -428,6 +672,20 @@ class FullTextSearch:
             result = session.execute(text(sql), {"id": subject_id}).scalar()
             return result
 
+    def get_refresh_stamp(self) -> Optional[str]:
+        """
+        Get the stamp the last refresh left in the mv_books_dc comment.
+
+        Timer.py sets it in the refresh transaction, so it changes exactly
+        when the view contents do.
+
+        Returns:
+            Refresh time as text, or None if the view was never stamped
+        """
+        sql = "SELECT obj_description(CAST('mv_books_dc' AS regclass), 'pg_class')"
+        with self.Session() as session:
+            return session.execute(text(sql)).scalar()
+
     def get_top_subjects_for_query(
         self, q: "SearchQuery", limit: int = 15, max_books: int = 1000
     ) -> List[Dict]:
@@ -445,29 +703,29 @@ class FullTextSearch:
         max_books = max(1, min(5000, int(max_books)))
         limit = max(1, min(100, int(limit)))
 
-        params = q._params()
+        params, search_sql, filters = q._clauses()
         order_sql = q._order_sql(params)
-        search_sql = " AND ".join(s[0] for s in q._search) if q._search else None
-        filter_sql = " AND ".join(f[0] for f in q._filters) if q._filters else None
-        where_parts = [p for p in (search_sql, filter_sql) if p]
+        where_parts = [search_sql] + filters if search_sql else filters
         where_clause = "WHERE {}".format(" AND ".join(where_parts)) if where_parts else ""
 
+        # subject_ids/subject_names are aggregated side by side in mv_books_dc,
+        # so the facet is counted from the view alone, without the base tables.
         sql = """
             WITH matched_books AS (
-                SELECT book_id
+                SELECT subject_ids, subject_names
                 FROM mv_books_dc
                 {}
                 ORDER BY {}
                 LIMIT :max_books
             )
             SELECT
-                s.pk AS id,
-                s.subject AS name,
+                u.id,
+                u.name,
                 COUNT(*) AS count
-            FROM matched_books mb
-            JOIN mn_books_subjects mbs ON mbs.fk_books = mb.book_id
-            JOIN subjects s ON s.pk = mbs.fk_subjects
-            GROUP BY s.pk, s.subject
+            FROM matched_books mb,
+                unnest(mb.subject_ids, mb.subject_names) AS u(id, name)
+            WHERE u.id IS NOT NULL
+            GROUP BY u.id, u.name
             ORDER BY count DESC
             LIMIT :limit
         """.format(where_clause, order_sql)
@@ -475,7 +733,7 @@ class FullTextSearch:
         params["max_books"] = max_books
 
         with self.Session() as session:
-            rows = session.execute(text(sql), params).fetchall()
+            rows = session.execute(_text(sql), params).fetchall()
             return [{"id": r.id, "name": r.name, "count": r.count} for r in rows]
 
     def get_locc_children(self, parent: Union[LoCCMainClass, str]) -> List[Dict]:
@@ -486,10 +744,9 @@ class FullTextSearch:
             parent_code = (parent or "").strip().upper()
 
         if not parent_code:
-            sorted_classes = sorted(LoCCMainClass, key=lambda x: x.code)
             return [
-                {"code": item.code, "label": item.label, "has_children": True}
-                for item in sorted_classes
+                {"code": code, "label": label, "has_children": True}
+                for code, label in _LOCC_MAIN
             ]
 
         sql = text("""